@@ -3,7 +3,7 @@
 SRC_DIR=`dirname $0`
 cd $SRC_DIR
 
-PYTHON=`which python3.4`
+PYTHON=`which python3`
 
 JOURNAL_DIR=/Users/bryanfeeney/opt-hillary/twextender.journal
 TWEETS_DIR=/Users/bryanfeeney/opt-hillary/twitter-tools-spider/src/test/resources/spider/_historic
@@ -10,28 +10,19 @@ It can do two things:
     will resume downloading tweets up to a limit given by the "-d" flag,
     which is a yyyy-mm-dd formatted date.
 """
-from optparse import OptionParser
+from argparse import ArgumentParser
 import sys
 import os
 import traceback
 from pathlib import Path
 from twextender import journal
 from twextender import tweet
-from twextender import downloader
 from dateutil import parser as dateparser
-from datetime import datetime
 
 TweetFileExt = ".historic.tweets.txt"
 
 def strip_timezone(old_date_time):
-    return datetime(
-        old_date_time.year,
-        old_date_time.month,
-        old_date_time.day,
-        old_date_time.hour,
-        old_date_time.minute,
-        old_date_time.month
-    )
+    return old_date_time.replace(tzinfo=None)
 
 def sanity_check(options, parser):
     """
@@ -78,22 +69,13 @@ def create_journal(tweets_dir, output_journal):
     populated with per-user journal programs by this function
     """
     lst = tweet.tweet_files(tweets_dir)
-    ids_and_dates = tweet.min_ids_and_dates(lst)
 
     # The same user may have appeared many times due to appearancs in different categories
-    user_ids = dict()
-    for cat_map in ids_and_dates.values():
-        for user, (tweet_id, tweet_date) in cat_map.items():
-            if user in user_ids:
-                if tweet_id < user_ids[user][0]:
-                    user_ids[user] = (tweet_id, tweet_date)
-            else:
-                user_ids[user] = (tweet_id, tweet_date)
+    user_ids = tweet.min_ids_and_dates_by_user(lst)
 
     # With clean map, start creating a journal
     jrnl = journal.Journal(output_journal)
-    for user, (tweet_id, tweet_date) in user_ids.items():
-        jrnl.finish(user_name=user, old_max_id=-1, new_max_id=tweet_id, new_max_date=tweet_date)
+    jrnl.finish_many((user, -1, tweet_id, tweet_date) for user, (tweet_id, tweet_date) in user_ids.items())
 
     print(str(len(user_ids)) + " user-records written to journal at " + output_journal)
 
@@ -108,68 +90,89 @@ def process_journal (tweets_dir, input_journal, min_tweet_date):
     :param input_journal: the journal directory whose contents will drive this method.
     :param min_tweet_date: we don't download tweets occurring before this date
     """
-    jrnl = journal.Journal(input_journal)
-    for screen_name in jrnl.journalled_users():
-        print (screen_name)
-        resp = jrnl.try_start(screen_name)
-        if resp.result_type is journal.JournalResultType.Found:
-            max_id, last_tweet_date = resp.max_id, strip_timezone(resp.last_tweet_date_utc)
-            print (" --> Last tweet " + str(max_id) + "@" + str(last_tweet_date))
-        elif resp.result_type is journal.JournalResultType.InUse:
-            print (" --> In-use, being spidered elsewhere?")
-            continue
-        else:
-            raise ValueError ("Unexpected result type " + str(resp))
+    # Imported here as it pulls in tweepy, which creating a journal doesn't need
+    from twextender import downloader
 
+    jrnl = journal.Journal(input_journal)
+    for screen_name in jrnl.iter_users_after(min_tweet_date):
+        # The user's name is written straight away, so that anything else written
+        # (e.g. rate-limit pauses) can be told apart, but the rest of the progress is
+        # buffered, and written out in one go when the user is done, or before we
+        # start downloading
+        sys.stdout.write(screen_name + "\n")
+        log = []
         try:
-            if last_tweet_date < min_tweet_date:
-                print (" --> Skipping as last tweet date " + str(last_tweet_date) + " predates the minimum " + str(min_tweet_date))
-                tweets = []
+            resp = jrnl.try_start(screen_name)
+            if resp.result_type is journal.JournalResultType.Found:
+                max_id, last_tweet_date = resp.max_id, strip_timezone(resp.last_tweet_date_utc)
+                log.append(f" --> Last tweet {max_id}@{last_tweet_date}")
+            elif resp.result_type is journal.JournalResultType.InUse:
+                log.append(" --> In-use, being spidered elsewhere?")
+                continue
             else:
-                print (" --> Downloading tweets")
-                tweets = downloader.tweets_for_user(screen_name, max_id=max_id, min_date=min_tweet_date)
-                print (" --> Downloaded %d tweets" % (len(tweets),))
-
-                fname = tweets_dir + os.sep + screen_name + TweetFileExt
-                with open (fname, "w") as f:
-                    f.writelines(str(t) + '\n' for t in tweets)
-                print (" --> Wrote tweets to file " + fname)
-
-            if len (tweets) > 0:
-                jrnl.finish(
-                    screen_name,
-                    old_max_id=max_id,
-                    new_max_id=tweets[-1].tweet.tweet_id,
-                    new_max_date=tweets[-1].utc_date
-                )
-            else:
-                jrnl.finish(
-                    screen_name,
-                    old_max_id=max_id,
-                    new_max_id=max_id,
-                    new_max_date=last_tweet_date
-                )
-        except Exception as e:
-            jrnl.abandon(screen_name, old_max_id=max_id)
-            print (" --> Error: " + str(e))
-            traceback.print_exc()
-
-
-
+                raise ValueError ("Unexpected result type " + str(resp))
+
+            try:
+                if last_tweet_date < min_tweet_date:
+                    log.append(f" --> Skipping as last tweet date {last_tweet_date} predates the minimum {min_tweet_date}")
+                    last_tweet = None
+                else:
+                    log.append(" --> Downloading tweets")
+                    write_log(log)
+                    fname = os.path.join(tweets_dir, f"{screen_name}{TweetFileExt}")
+                    count, last_tweet = 0, None
+                    with tweet.TweetFileWriter(fname) as out:
+                        for t in downloader.tweets_for_user(screen_name, max_id=max_id, min_date=min_tweet_date):
+                            out.write(t)
+                            count, last_tweet = count + 1, t
+                    log.append(f" --> Downloaded {count} tweets")
+                    log.append(f" --> Wrote tweets to file {fname}")
+
+                if last_tweet is not None:
+                    jrnl.finish(
+                        screen_name,
+                        old_max_id=max_id,
+                        new_max_id=last_tweet.tweet.tweet_id,
+                        new_max_date=last_tweet.utc_date
+                    )
+                else:
+                    jrnl.finish(
+                        screen_name,
+                        old_max_id=max_id,
+                        new_max_id=max_id,
+                        new_max_date=last_tweet_date
+                    )
+            except Exception as e:
+                jrnl.abandon(screen_name, old_max_id=max_id)
+                log.append(f" --> Error: {e}")
+                write_log(log)
+                sys.stdout.flush() # The traceback goes to stderr, so has to follow this
+                traceback.print_exc()
+        finally:
+            write_log(log)
+
+
+def write_log(log):
+    """
+    Writes out the given list of buffered progress lines, if any, and empties it
+    """
+    if len(log) > 0:
+        sys.stdout.write("\n".join(log) + "\n")
+        log.clear()
 
 if __name__ == "__main__":
-    usage = "Usage: %prog [options]"
-    parser = OptionParser()
-    parser.add_option("-c", "--create-journal", dest="output_journal",
-                      help="Create a journal saved at the given OUT path", metavar="OUT")
-    parser.add_option("-p", "--process-journal", dest="input_journal",
-                      help="Open the given INPUT journal and start downloading tweets", metavar="INPUT")
-    parser.add_option("-d", "--target-date", dest="target_date", metavar="DATE",
-                      help="When downloading tweets, stop once this threshold has been passed (going back)")
-    parser.add_option("-t", "--tweets-dir", dest="tweets_dir", metavar="TDIR",
-                      help="The directory where tweets are read from, or written to")
-
-    (options, args) = parser.parse_args()
+    usage = "%(prog)s [options]"
+    parser = ArgumentParser(usage=usage)
+    parser.add_argument("-c", "--create-journal", dest="output_journal",
+                        help="Create a journal saved at the given OUT path", metavar="OUT")
+    parser.add_argument("-p", "--process-journal", dest="input_journal",
+                        help="Open the given INPUT journal and start downloading tweets", metavar="INPUT")
+    parser.add_argument("-d", "--target-date", dest="target_date", metavar="DATE",
+                        help="When downloading tweets, stop once this threshold has been passed (going back)")
+    parser.add_argument("-t", "--tweets-dir", dest="tweets_dir", metavar="TDIR",
+                        help="The directory where tweets are read from, or written to")
+
+    options = parser.parse_args()
     sanity_check(options, parser)
 
 
@@ -0,0 +1,19 @@
+"""
+Date parsing shared by the journal and tweet modules.
+"""
+from datetime import datetime
+from dateutil import parser as dateparser
+
+
+def parse_iso_date(date_str):
+    """
+    Parses a date written out by <code>datetime.isoformat()</code>, as every date in
+    a journal or tweets file should be, using the fast, C-implemented
+    <code>datetime.fromisoformat()</code>. Anything that isn't in that format (e.g. a
+    form fromisoformat doesn't accept in this version of Python) falls back to the
+    much slower, generic dateutil parser.
+    """
+    try:
+        return datetime.fromisoformat(date_str)
+    except ValueError:
+        return dateparser.parse(date_str)
@@ -10,32 +10,63 @@ import re
 from . import tweet
 
 LastTwitterLink = re.compile("\\s*https?://t\\.co/[A-Za-z0-9]{8,12}\\s*$", re.IGNORECASE)
+Whitespace = re.compile("\\s+")
+
+RateLimitPauseSecs = 15 * 60 # How long to pause when rate-limited, if Twitter doesn't say
 
 # Consumer keys and access tokens, used for OAuth. This is a dictionary
 # with the string keys "consumer", "consumer_secret", "access_token" and
 # "access_token_secret"
-with open('/Users/bryanfeeney/twitter.budge.key', 'r') as f:
-    keys = json.load(f)
+KeysFile = '/Users/bryanfeeney/twitter.budge.key'
+
+# The Twitter interface, created on first use by _get_api()
+_api = None
 
+def _get_api():
+    """
+    Returns the authenticated Twitter interface, reading the keys and creating it on
+    the first call, so that merely importing this module costs no I/O.
+    """
+    global _api
+    if _api is None:
+        with open(KeysFile, 'r') as f:
+            keys = json.load(f)
 
-# OAuth process, using the keys and tokens
-auth = tweepy.OAuthHandler(keys['consumer'], keys['consumer_secret'])
-auth.set_access_token(keys['access_token'], keys['access_token_secret'])
+        # OAuth process, using the keys and tokens
+        auth = tweepy.OAuthHandler(keys['consumer'], keys['consumer_secret'])
+        auth.set_access_token(keys['access_token'], keys['access_token_secret'])
 
-# Creation of the actual interface, using authentication
-twitter = tweepy.API(auth)
+        # Creation of the actual interface, using authentication
+        _api = tweepy.API(auth)
+    return _api
+
+def pause_for_rate_limit(e):
+    """
+    Sleeps until the rate-limit window reported in the headers of the given error's
+    response resets (plus a second's grace), or for RateLimitPauseSecs if Twitter
+    didn't say when that would be.
+    """
+    response = getattr(e, 'response', None)
+    reset = None if response is None else response.headers.get('x-rate-limit-reset')
+    try:
+        pause_secs = max(0, int(reset) - time.time()) + 1
+    except (TypeError, ValueError):
+        pause_secs = RateLimitPauseSecs
+
+    print (" *** Paused for %ds, rate-limit exceeded" % (pause_secs,))
+    time.sleep(pause_secs)
 
 def limit_handled(cursor):
     while True:
         try:
             yield cursor.next()
-        except tweepy.RateLimitError:
-            print (" *** Paused, rate-limit exceeded")
-            time.sleep(15 * 60)
+        except StopIteration:
+            return
+        except tweepy.RateLimitError as e:
+            pause_for_rate_limit(e)
         except tweepy.TweepError as e:
             if e.response.status_code == 429 or e.response.status_code == 420:
-                print (" *** Paused, rate-limit exceeded")
-                time.sleep(15 * 60)
+                pause_for_rate_limit(e)
             else:
                 raise e
 
@@ -43,60 +74,84 @@ def limit_handled(cursor):
 def tweets_for_user(screen_name, max_id, min_date):
     """
     Gets as many tweets as possible for a user, starting from the max_id, and continuing up
-    till the since_date, in short blocks, so we don't blow our RateLimit budget.
+    till the min_date, in short blocks, so we don't blow our RateLimit budget.
 
-    Return a tuple of the tweets and a boolean to indicate if more tweets are available (true)
-    or not (false)
+    This is a generator: tweets are yielded as they're downloaded, so the caller can write
+    them out as it goes rather than holding a user's entire timeline in memory. If the
+    download is interrupted by a rate-limit it's resumed from the last tweet yielded.
 
     :param screen_name: the screen-name of the user whose tweets we want
     :param max_id: we gather all tweets occurring before the tweet with this <code>max_id</code>
     :param min_date: we gather all tweets occurring after this date. This is a <code>datetime<code>
     object
-    :return: a tuple: first the list of downloaded tweets, in an arbitrary order; second a boolean
-    indicating if more tweets are available to download (true) or not (false)
+    :return: a generator of the downloaded tweets, newest first. The tweet with the given
+    <code>max_id</code> is not included.
     """
-    result = []
     attempts = 3
+    utc_offset = None # The same for every tweet in the timeline, so found just once
 
     while attempts > 0:
         attempts -= 1
         try:
-            for status in limit_handled(tweepy.Cursor(twitter.user_timeline, screen_name=screen_name, exclude_replies=True, tweet_mode="extended", max_id=max_id).items()):
-                result.append(status_to_tweet(status))
-                if status.created_at < min_date:
-                    return result
-        except tweepy.RateLimitError:
-            print(" *** Paused, rate-limit exceeded")
-            time.sleep(15 * 60)
+            for page in limit_handled(tweepy.Cursor(_get_api().user_timeline, screen_name=screen_name, exclude_replies=True, tweet_mode="extended", max_id=max_id).pages()):
+                if len(page) == 0:
+                    continue
+                if utc_offset is None:
+                    utc_offset = utc_offset_of(page[0].user)
+
+                # Tweets come newest first, so only a page whose last tweet predates
+                # min_date needs its tweets' dates checked
+                reaches_min_date = page[-1].created_at < min_date
+                for status in page:
+                    # max_id is inclusive, and we already have that tweet
+                    if status.id == max_id:
+                        continue
+                    max_id = status.id
+                    yield status_to_tweet(status, utc_offset)
+                    if reaches_min_date and status.created_at < min_date:
+                        return
+            return
+        except tweepy.RateLimitError as e:
+            pause_for_rate_limit(e)
         except tweepy.TweepError as e:
             if e.response.status_code == 429 or e.response.status_code == 420:
-                print(" *** Paused, rate-limit exceeded")
-                time.sleep(15 * 60)
+                pause_for_rate_limit(e)
             else:
                 raise e
 
 
-    if len(result) > 0 and result[0].tweet.tweet_id == max_id:
-        del result[0]
-    return result
+def utc_offset_of(user):
+    """
+    Returns the offset from UTC of the given tweepy.User's local time, as a timedelta,
+    or a zero timedelta if it's unknown
+    """
+    # TODO Figure out the timezone stuff
+    offset_seconds = getattr(user, 'utc_offset', None)
+    return timedelta(seconds=0 if offset_seconds is None else offset_seconds)
 
 
-def status_to_tweet(status):
+def status_to_tweet(status, utc_offset=None):
     """
     Converts a tweepy.Status object to a tweet.Tweet object. The local_time field is not reliable.
-    """
-    # TODO Figure out the timezone stuff
-    offset_seconds = 0 if status.user.utc_offset is None else status.user.utc_offset
-    local_date = status.created_at + timedelta(seconds=offset_seconds)
 
-    if hasattr (status, 'retweeted_status'):
-        rstatus = status.retweeted_status
-        if hasattr(rstatus, 'quoted_status'):
-            qstatus = rstatus.quoted_status
+    :param status: the tweepy.Status to convert
+    :param utc_offset: the <code>utc_offset_of(status.user)</code>, which callers converting
+    many statuses from the one timeline can look up once and pass in. If None it's looked up
+    from the status.
+    """
+    if utc_offset is None:
+        utc_offset = utc_offset_of(status.user)
+    local_date = status.created_at + utc_offset if utc_offset else status.created_at
+
+    rstatus = getattr(status, 'retweeted_status', None)
+    if rstatus is not None:
+        qstatus = getattr(rstatus, 'quoted_status', None)
+        if qstatus is not None:
+            qid, qauthor, qtext = qstatus['id'], qstatus['user']['screen_name'], qstatus['full_text']
             qtweet  = tweet.TweetBody (
-                tweet_id=qstatus['id'],
-                author=qstatus['user']['screen_name'],
-                content=qstatus['full_text'],
+                tweet_id=qid,
+                author=qauthor,
+                content=qtext,
                 embedded_tweet=None,
                 embedded_url=None
             )
@@ -105,7 +160,7 @@ def status_to_tweet(status):
             qtweet = None
             retweet_text = rstatus.full_text
 
-        retweet_text =  re.sub("\\s+", " ", retweet_text)
+        retweet_text =  Whitespace.sub(" ", retweet_text)
 
         retweet = tweet.TweetBody(
             tweet_id=rstatus.id,
@@ -115,22 +170,24 @@ def status_to_tweet(status):
             embedded_url=None
         )
         tweet_text = ""
-    elif hasattr(status, 'quoted_status'):
-        qstatus = status.quoted_status
-        retweet = tweet.TweetBody(
-            tweet_id=qstatus['id'],
-            author=qstatus['user']['screen_name'],
-            content= re.sub("\\s+", " ", qstatus['full_text']),
-            embedded_tweet=None,
-            embedded_url=None
-        )
-        tweet_text = strip_last_twitter_link(status.full_text)
     else:
-        retweet = None
-        tweet_text = status.full_text
+        qstatus = getattr(status, 'quoted_status', None)
+        if qstatus is not None:
+            qid, qauthor, qtext = qstatus['id'], qstatus['user']['screen_name'], qstatus['full_text']
+            retweet = tweet.TweetBody(
+                tweet_id=qid,
+                author=qauthor,
+                content= Whitespace.sub(" ", qtext),
+                embedded_tweet=None,
+                embedded_url=None
+            )
+            tweet_text = strip_last_twitter_link(status.full_text)
+        else:
+            retweet = None
+            tweet_text = status.full_text
 
     # Get rid of raw-newlines in text
-    tweet_text = re.sub("\\s+", " ", tweet_text)
+    tweet_text = Whitespace.sub(" ", tweet_text)
 
     return tweet.TweetEnvelope(
         local_date=local_date,
@@ -145,5 +202,9 @@ def status_to_tweet(status):
     )
 
 def strip_last_twitter_link(text):
-    return re.sub(LastTwitterLink, "", text)
+    # Most texts don't end in a link, so check the tail for "t.co/" before running the
+    # regex. A matching link, trailing whitespace aside, is at most 25 characters long.
+    if "t.co/" not in text.rstrip()[-25:].lower():
+        return text
+    return LastTwitterLink.sub("", text)
 
@@ -7,7 +7,9 @@ users, and also to help ensure that the application can easily restart and conti
 where it left off should something go wrong.
 
 The "journal" in this case is a directory of per-user journals: this is just to
-ensure we don't spend too long reading a journal, and block other processes.
+ensure we don't spend too long reading a journal, and block other processes. The
+per-user journals are spread over 256 shard sub-directories, chosen by a hash of
+the user-name, so that no one directory gets too large.
 """
 
 from enum import Enum
@@ -15,16 +17,24 @@ from fcntl import flock, LOCK_EX, LOCK_NB, LOCK_UN
 import time
 import errno
 from datetime import datetime
-import dateutil.parser as dateparser
+from .dates import parse_iso_date
 from random import random
 from pathlib import Path
+import hashlib
+import mmap
 import os
+import signal
+import threading
 
 JOURNAL_FILE_EXT = ".journal"
+JOURNAL_INDEX_FILE = ".index" # Hidden, so it's never mistaken for a user's journal
 
 JOURNAL_ACCESS_TIMEOUT_SECS=3 * 60 # How long will it take to read and parse an entire journal
 TRANSACTION_EXPIRY_TIMEOUT_SECS=5 * 60
 
+# Missing fields are written out empty, but journals written by older versions have "None"
+MISSING_FIELDS = ("", str(None))
+
 class JournalResultType (Enum):
     NotFound = 1
     Found = 2
@@ -36,6 +46,8 @@ class JournalResponse:
     The response to a query on the journal. Note that max_id and last_access
     may be undefined if the result_type is NotFound
     """
+    __slots__ = ('result_type', 'user', '_max_id', '_last_access', '_last_tweet_date_utc')
+
     def __init__(self, result_type, user, max_id, last_access, last_tweet_date_utc):
        self.result_type  = result_type
        self.user         = user
@@ -89,10 +101,16 @@ class JournalEntryType(Enum):
     Abandoned = 1
     Finished  = 2
 
+# Looking names up in a plain dict is quicker than JournalEntryType[name], and is
+# done for every journal line read
+_ENTRY_TYPE_BY_NAME = {m.name: m for m in JournalEntryType}
+
 class JournalEntry:
     """
     An entry in a journal file.
     """
+    __slots__ = ('date', 'user_name', '_lwr_user_name', 'entry_type', 'old_max_id', 'new_max_id', 'new_max_date')
+
     def __init__(self, date, user_name, entry_type, old_max_id, new_max_id, new_max_date):
         self.date           = date
         self.user_name      = user_name
@@ -151,17 +169,17 @@ class JournalEntry:
     @classmethod
     def from_str(cls, line):
         parts = line.strip().split('\t')
-        entry_date = dateparser.parse(parts[0])
+        entry_date = parse_iso_date(parts[0])
         user_name = parts[1]
-        entry_type = JournalEntryType[parts[2]]
+        entry_type = _ENTRY_TYPE_BY_NAME[parts[2]]
 
         old_id, new_id, last_access_date = None, None, None
         if len(parts) > 3:
-            old_id = None if parts[3] == str(None) else int(parts[3])
+            old_id = None if parts[3] in MISSING_FIELDS else int(parts[3])
         if len(parts) > 4:
-            new_id = None if parts[4] == str(None) else int(parts[4])
+            new_id = None if parts[4] in MISSING_FIELDS else int(parts[4])
         if len(parts) > 5:
-            last_access_date = None if parts[5] == str(None) else dateparser.parse(parts[5])
+            last_access_date = None if parts[5] in MISSING_FIELDS else parse_iso_date(parts[5])
 
         result = JournalEntry(
             entry_date,
@@ -174,13 +192,26 @@ class JournalEntry:
 
         return result
 
+    @classmethod
+    def from_bytes(cls, line):
+        """
+        Parse an entry from a line of a journal file read in binary mode
+        """
+        return JournalEntry.from_str(line.decode('utf-8'))
+
+    def to_bytes(self):
+        """
+        The line, including its newline, which records this entry in a journal file, as UTF-8
+        encoded bytes, ready to be written out with a single write() to a file opened in
+        binary mode.
+        """
+        return (str(self) + '\n').encode('utf-8')
+
     def __str__(self):
-        return       self.date.isoformat() \
-            + '\t' + self.user_name \
-            + '\t' + self.entry_type.name \
-            + '\t' + (str(None) if self.old_max_id   is None else str(self.old_max_id)) \
-            + '\t' + (str(None) if self.new_max_id   is None else str(self.new_max_id)) \
-            + '\t' + (str(None) if self.new_max_date is None else self.new_max_date.isoformat())
+        return f"{self.date.isoformat()}\t{self.user_name}\t{self.entry_type.name}" \
+            f"\t{'' if self.old_max_id   is None else self.old_max_id}" \
+            f"\t{'' if self.new_max_id   is None else self.new_max_id}" \
+            f"\t{'' if self.new_max_date is None else self.new_max_date.isoformat()}"
 
 
 
@@ -218,32 +249,60 @@ class Journal:
         :param journal_dir: the directory where the journals should go.
         """
         self._journal_dir = journal_dir
+        self._tail_cache  = dict() # journal file -> _JournalTail
+        self._shard_dirs  = set()  # shard directories known to exist
         path = Path(journal_dir)
         if not path.exists():
             path.mkdir(parents=False)
+        self._shard_flat_journals()
 
     def abandon(self, user_name, old_max_id):
         """
         Record that we had to abandon the last twitter read attempt
         """
         entry = JournalEntry.abandoned_now(user_name, old_max_id)
-        with open(self._journal_for_user(user_name), "a") as f:
-            try_lock(f, JOURNAL_ACCESS_TIMEOUT_SECS)
-            try:
-                f.write(str(entry) + '\n')
-            finally:
-                unlock(f)
+        append_atomically(self._journal_for_user(user_name), entry.to_bytes())
 
     def finish(self, user_name, old_max_id, new_max_id, new_max_date):
         """
         Record that we've finished processing a user, having started reading tweets
         earlier than old_max_id, and having read a batch whose minimum is new_max_id
+
+        Like abandon() this takes no lock: a single short entry is appended with one
+        atomic write, so it can't interleave with another process's, and readers in
+        try_start() only ever see whole lines.
         """
         entry = JournalEntry.finished_now(user_name, old_max_id, new_max_id, new_max_date)
-        with open(self._journal_for_user(user_name), "a") as f:
+        append_atomically(self._journal_for_user(user_name), entry.to_bytes())
+        append_atomically(self._index_file(), index_line(entry))
+
+    def finish_many(self, records):
+        """
+        Calls finish() for many users at once. Each record is a tuple of
+        (user_name, old_max_id, new_max_id, new_max_date). All the entries for a
+        given user are written out with a single open, lock and write of that
+        user's journal. Unlike finish() this does lock, as a batch of entries may be
+        too large to be appended atomically.
+        """
+        lines_by_user = dict()
+        index_lines = []
+        for user_name, old_max_id, new_max_id, new_max_date in records:
+            entry = JournalEntry.finished_now(user_name, old_max_id, new_max_id, new_max_date)
+            lines_by_user.setdefault(user_name.lower(), []).append(entry.to_bytes())
+            index_lines.append(index_line(entry))
+
+        for user_name, lines in lines_by_user.items():
+            self._append(self._journal_for_user(user_name), b''.join(lines))
+        self._append(self._index_file(), b''.join(index_lines))
+
+    def _append(self, path, data):
+        """
+        Append the given bytes, one or more serialized lines, to the given journal file
+        """
+        with open(path, "ab") as f:
             try_lock(f, JOURNAL_ACCESS_TIMEOUT_SECS)
             try:
-                f.write(str(entry) + '\n')
+                f.write(data)
             finally:
                 unlock(f)
 
@@ -261,102 +320,284 @@ class Journal:
         :return: False if a record for this user already exists in the file,
         True otherwise
         """
-        with open(self._journal_for_user(user_name), "r+") as f:
+        journal_file = self._journal_for_user(user_name)
+
+        # If we've been given a max_id, don't bother checking the journal, or
+        # even locking it, just append the entry
+        if from_max_id is not None:
+            entry = JournalEntry.started_now(user_name, from_max_id)
+            append_atomically(journal_file, entry.to_bytes())
+            return JournalResponse.in_use(entry)
+
+        with open(journal_file, "ab+") as f: # Creates the journal if need be
             try:
                 try_lock(f, JOURNAL_ACCESS_TIMEOUT_SECS)
 
-                # If we've been given a max_id, don't bother checking the journal
-                if from_max_id is not None:
-                    f.seek(0, 2) # Go to the end (zero-bytes before SEEK_END=2)
-                    entry = JournalEntry.started_now(user_name, from_max_id)
-                    f.write(str(entry) + '\n')
-                    return JournalResponse.in_use(entry)
-                else:
-
-                    # Find all the journal entries for the given user. Condense
-                    # start-finish pairs to just a single finished record (do the
-                    # same for abandoned).
-                    user_entries = []
-                    for line in f:
-                        line = line.strip()
-                        if len(line) == 0:
-                            continue
-
-                        entry = JournalEntry.from_str(line)
-
-                        if not entry.is_for_user(user_name):
-                            raise ValueError ("Invalid journal file, wrong user found")
-
-                        if len(user_entries) == 0:
-                            user_entries.append(entry)
-                        else:
-                            if entry.is_completion_of(user_entries[-1]):
-                                user_entries.pop()
-                            user_entries.append(entry)
-
-                    # Go back to last successfully completed journal entry
-                    # Immediately write a record to the journal once we've found it
-                    while len(user_entries) > 0:
-                        l = user_entries.pop()
-                        if l.entry_type is JournalEntryType.Started:
-                            if not l.is_expired():
-                                return JournalResponse.in_use(l)
-                        elif l.entry_type is JournalEntryType.Finished:
-                            resp     = JournalResponse.found(l)
-                            newEntry = JournalEntry.started_now(user_name, resp.max_id)
-                            f.write(str(newEntry) + '\n')
-                            return resp
-
-                    newEntry = JournalEntry.started_now(user_name, None)
-                    f.write(str(newEntry) + '\n')
-                    return JournalResponse.not_found(user_name)
+                # Go back from the end of the journal to the last successfully
+                # completed journal entry, ignoring start-finish pairs (and
+                # start-abandoned pairs). Immediately write a record to the
+                # journal once we've found it
+                newer = None
+                for l in self._entries_newest_first(journal_file, f, user_name):
+                    completed = newer is not None and l.is_completion_of(newer)
+                    newer = l
+                    if completed:
+                        continue
+
+                    if l.entry_type is JournalEntryType.Started:
+                        if not l.is_expired():
+                            return JournalResponse.in_use(l)
+                    elif l.entry_type is JournalEntryType.Finished:
+                        resp     = JournalResponse.found(l)
+                        newEntry = JournalEntry.started_now(user_name, resp.max_id)
+                        self._write_entry(journal_file, f, newEntry)
+                        return resp
+
+                newEntry = JournalEntry.started_now(user_name, None)
+                self._write_entry(journal_file, f, newEntry)
+                return JournalResponse.not_found(user_name)
             finally:
                 unlock(f)
 
+    def _entries_newest_first(self, journal_file, f, user_name):
+        """
+        Yields the entries of the given, open and locked, journal file, starting from the
+        last. The file is memory-mapped and read backwards, line by line, only as far as
+        the caller iterates, so the common case only reads the last few lines.
+
+        The entries already read are cached, and are reused without reading the file at
+        all on the next call if the file's size and modification time are unchanged.
+        """
+        stat = os.fstat(f.fileno())
+        tail = self._tail_cache.get(journal_file)
+        if tail is None or (tail.size, tail.mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+            tail = _JournalTail(stat.st_size, stat.st_mtime_ns)
+            self._tail_cache[journal_file] = tail
+
+        for entry in list(tail.entries):
+            yield entry
+
+        if tail.unread_end == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            end = tail.unread_end
+            while end > 0:
+                # Search before end - 1, to skip the newline terminating this line
+                start = mm.rfind(b'\n', 0, end - 1) + 1
+                line  = mm[start:end].strip()
+                tail.unread_end = end = start
+                if len(line) == 0:
+                    continue
+
+                entry = JournalEntry.from_bytes(line)
+
+                if not entry.is_for_user(user_name):
+                    raise ValueError ("Invalid journal file, wrong user found")
+
+                tail.entries.append(entry)
+                yield entry
+
+    def _write_entry(self, journal_file, f, entry):
+        """
+        Append the given entry to the given, open and locked, journal file, adding it to
+        the cached entries for that file if they're still up to date.
+        """
+        data = entry.to_bytes()
+        end  = f.seek(0, 2) # Go to the end (zero-bytes before SEEK_END=2)
+        f.write(data)
+        f.flush()
+
+        stat = os.fstat(f.fileno())
+        tail = self._tail_cache.get(journal_file)
+        if tail is not None and tail.size == end and stat.st_size == end + len(data):
+            tail.entries.insert(0, entry)
+            tail.size, tail.mtime_ns = stat.st_size, stat.st_mtime_ns
+        else:
+            self._tail_cache.pop(journal_file, None)
 
     def journalled_users(self):
         """
         Return a list of users that are journalled
         """
-        journal_files = os.listdir(self._journal_dir)
-        maybe_users = [self._user_for_journal(self._journal_dir + os.sep + f) for f in journal_files]
+        with os.scandir(self._journal_dir) as entries:
+            shard_dirs = [d.path for d in entries if not d.name.startswith(".") and d.is_dir()]
+
+        users = []
+        for shard_dir in shard_dirs:
+            users.extend(journalled_users_in(shard_dir))
+        return users
+
+    def iter_users_after(self, min_date):
+        """
+        Yields the journalled users who may still have tweets to download dating from
+        after min_date. This is every user except those whose last finished batch, as
+        recorded in the journal's index, already reached back before min_date. Users
+        missing from the index are always yielded.
+
+        This only reads the index, so the per-user journals need never be opened for
+        users who are already done.
+        """
+        last_dates = self._read_index()
+        for user_name in self.journalled_users():
+            last_date = last_dates.get(user_name.lower())
+            if last_date is None or last_date.replace(tzinfo=None) >= min_date:
+                yield user_name
+
+    def _index_file(self):
+        """
+        Return the path of the index which records the date of the oldest tweet downloaded
+        for each user, updated whenever a batch is finished.
+        """
+        return self._journal_dir + "/" + JOURNAL_INDEX_FILE
+
+    def _read_index(self):
+        """
+        Return a map of lower-cased user-names to their last tweet dates according to the
+        index. If a user has several index lines, the last one is used.
+        """
+        if not Path(self._index_file()).exists():
+            return dict()
+
+        # The index gains a line per finished batch, so most of its lines are out of
+        # date: find each user's last line first, and only parse the dates of those.
+        last_date_strs = dict()
+        with open(self._index_file(), "rb") as f:
+            for line in f:
+                user_name, sep, date_str = line.rstrip(b'\r\n').partition(b'\t')
+                if sep:
+                    last_date_strs[user_name] = date_str
 
-        return [u for u in maybe_users if u is not None]
+        last_dates = dict()
+        for user_name, date_str in last_date_strs.items():
+            date_str = date_str.decode('ascii')
+            last_dates[user_name.decode('utf-8')] = None if date_str in MISSING_FIELDS else parse_iso_date(date_str)
+        return last_dates
 
 
     def _journal_for_user (self, user_name):
         """
-        Return the journal file for the given user. Ensure it exists.
+        Return the journal file for the given user. This may not exist yet: it's up
+        to callers to open it in an append mode, which creates it if necessary.
         :param user_name: the "screen name" of a twitter user.
         :return: a path (as a string) to a file.
         """
-        journal_file = self._journal_dir + "/" + user_name.lower() + JOURNAL_FILE_EXT
-        Path(journal_file).touch(exist_ok=True)
-        return journal_file
-
-    def _user_for_journal(self, user_journal_path):
+        user_name = user_name.lower()
+        shard_dir = self._journal_dir + "/" + journal_shard(user_name)
+        if shard_dir not in self._shard_dirs:
+            os.makedirs(shard_dir, exist_ok=True)
+            self._shard_dirs.add(shard_dir)
+        return shard_dir + "/" + user_name + JOURNAL_FILE_EXT
+
+    def _shard_flat_journals(self):
         """
-        Return the screen name associated with a given journal file. If the file in
-        question does not match the expected journal format, return None instead.
+        Journals used to be written directly into the journal directory, rather than
+        into shards. Move any such journals into their shards. Renaming keeps the
+        file's inode, and so any lock another process already holds on it.
         """
-        path = Path(user_journal_path)
-        if not path.is_file():
-            return None
-        name = path.name
+        for user_name in journalled_users_in(self._journal_dir):
+            journal_file = self._journal_for_user(user_name)
+            if os.path.exists(journal_file):
+                continue # Don't overwrite a sharded journal: leave the old one alone
+            try:
+                os.rename(self._journal_dir + "/" + user_name + JOURNAL_FILE_EXT, journal_file)
+            except FileNotFoundError:
+                pass # Another process has already moved it
+
+
+
+class _JournalTail:
+    """
+    The last few entries of a journal file, as cached by a Journal between calls to
+    try_start(). The entries, newest first, are those parsed from the bytes between
+    unread_end and the end of the file, which was size bytes long, and last modified
+    at mtime_ns, when they were read.
+    """
+    __slots__ = ('size', 'mtime_ns', 'entries', 'unread_end')
+
+    def __init__(self, size, mtime_ns):
+        self.size       = size
+        self.mtime_ns   = mtime_ns
+        self.entries    = []
+        self.unread_end = size
 
-        if name.startswith("."):
-            return None
-        if not name.endswith(JOURNAL_FILE_EXT):
-            return None
 
-        return name[0:-len(JOURNAL_FILE_EXT)]
+def index_line(entry):
+    """
+    Return the journal-index line, as UTF-8 bytes, recording the new_max_date of the
+    given finished entry
+    """
+    return f"{entry.user_name.lower()}\t{'' if entry.new_max_date is None else entry.new_max_date.isoformat()}\n".encode('utf-8')
+
+
+def journal_shard(user_name):
+    """
+    Return the name of the shard directory holding the given (lower-cased) user's
+    journal: one of 256, chosen by hashing the user-name, so no one directory has
+    to hold every user's journal.
+    """
+    return hashlib.blake2b(user_name.encode('utf-8'), digest_size=1).hexdigest()
+
+
+def journalled_users_in(dir):
+    """
+    Return the users whose journals are directly within the given directory
+    """
+    # scandir() gives us each file's type without a stat() per file
+    with os.scandir(dir) as journal_files:
+        return [
+            f.name[0:-len(JOURNAL_FILE_EXT)] for f in journal_files
+            if f.name.endswith(JOURNAL_FILE_EXT) and not f.name.startswith(".") and f.is_file()
+        ]
 
 
+def append_atomically(path, data):
+    """
+    Appends the given bytes to the given file, without locking it. The file is opened
+    with O_APPEND and written, unbuffered, with a single write(), which POSIX makes
+    atomic with respect to other appends, provided we write less than PIPE_BUF
+    bytes (at least 512), as a journal entry always does.
+    """
+    with open(path, "ab", buffering=0) as f:
+        f.write(data)
+
 
 def try_lock(fd, timeout_secs):
     """
     Tries to lock the given file. Waits a total of timeout_secs to do so.
     If it can't get a lock in that time, raises a BlockingIOError
+
+    In the main thread this waits in the kernel, in a blocking flock(), which an
+    interval timer interrupts once timeout_secs have passed, so the lock is taken
+    as soon as it's released. Only the main thread can handle signals, so other
+    threads poll for the lock instead.
+    """
+    try:
+        flock(fd, LOCK_EX | LOCK_NB)
+        return
+    except BlockingIOError:
+        if timeout_secs <= 0:
+            raise
+
+    if threading.current_thread() is not threading.main_thread():
+        _poll_lock(fd, timeout_secs)
+        return
+
+    def on_timeout(signum, frame):
+        raise BlockingIOError(errno.EAGAIN, "Timed out after %gs waiting for a lock" % (timeout_secs,))
+
+    previous_handler = signal.signal(signal.SIGALRM, on_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout_secs)
+    try:
+        flock(fd, LOCK_EX)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+def _poll_lock(fd, timeout_secs):
+    """
+    Tries to lock the given file by repeatedly polling for it. Waits a total of
+    timeout_secs to do so. If it can't get a lock in that time, raises a
+    BlockingIOError
     """
     while True:
         try:
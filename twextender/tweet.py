@@ -1,15 +1,23 @@
 """
-This module contains a representation of a tweet, and code for reading tweets from
-a file written out by the Java based twitter spider.
+This module contains a representation of a tweet, code for reading tweets from
+a file written out by the Java based twitter spider, and code for writing tweets
+files in the same format.
 """
-from dateutil import parser as dateparser
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
 import os
-from pathlib import Path
+import queue
+import threading
+from .dates import parse_iso_date
 
 
 MinAsSecs  = 60
 HourAsSecs = 60 * MinAsSecs
-QuarterHourAsSecs = HourAsSecs / 4
+QuarterHourAsSecs = HourAsSecs // 4
+
+MaxIoThreads = 8 # How many threads to use when reading many tweet files at once
+MaxQueuedWrites = 1000 # How many tweets a TweetFileWriter may have waiting to be written
+PartialFileExt = ".part" # Added to the name of a tweets file while it's being written
 
 class UrlCard:
     """
@@ -17,6 +25,8 @@ class UrlCard:
     represented by "cards". This contains the card details, and -- if it was read --
     the card content
     """
+    __slots__ = ('url', 'card_url', 'title', 'content')
+
     def __init__(self, url, card_url, title=None, content=None):
         self.url      = url
         self.card_url = card_url
@@ -66,6 +76,8 @@ class TweetBody:
     which will contain date information and the account in which this tweet appeared (some
     tweets may appear in different accounts if they're directly retweeted)
     """
+    __slots__ = ('tweet_id', 'author', 'content', 'embedded_url', 'embedded_tweet')
+
     def __init__(self, tweet_id, author, content, embedded_url, embedded_tweet):
         """
         Build a tweet
@@ -99,22 +111,33 @@ class TweetBody:
         """
         Given a list of fields (e.g. parsed out of a tab-delimited line) build a TweetBody
         object. Return a tuple of the  TweetBody and the next position to read from.
+
+        Each tweet is followed by the tweet it embeds, if any, so a chain of quote-tweets
+        is read with a loop, rather than by recursion: the tweets are stacked as they're
+        read, and then built up from the innermost, which embeds nothing, outwards.
         """
-        author = fields[start + 0]
-        id     = int(fields[start + 1])
-        msg    = fields[start + 2]
+        stack = [] # (id, author, msg, url_card) for each tweet in the chain
+        while True:
+            author = fields[start + 0]
+            id     = int(fields[start + 1])
+            msg    = fields[start + 2]
 
-        url_card, next_start = \
-            UrlCard.from_str_fields(fields, start + 4) \
-            if fields[start + 3].lower() == "some" \
-            else (None, start + 4)
+            url_card, start = \
+                UrlCard.from_str_fields(fields, start + 4) \
+                if fields[start + 3].lower() == "some" \
+                else (None, start + 4)
 
-        embed_tweet, next_next_start = \
-            TweetBody.from_str_fields(fields, next_start + 1) \
-            if fields[next_start].lower() == "some" \
-            else (None, next_start + 1)
+            stack.append((id, author, msg, url_card))
+            has_embed = fields[start].lower() == "some"
+            start += 1
+            if not has_embed:
+                break
 
-        return TweetBody(id, author, msg, url_card, embed_tweet), next_next_start
+        embed_tweet = None
+        for id, author, msg, url_card in reversed(stack):
+            embed_tweet = TweetBody(id, author, msg, url_card, embed_tweet)
+
+        return embed_tweet, start
 
 
 
@@ -123,10 +146,13 @@ class TweetEnvelope:
     The "envelope" for a tweet is the date and account information for a tweet. A tweet
     in this case is actually a chain of tweets containing tweets containing tweets
     """
+    __slots__ = ('utc_date', 'local_date', 'tweet', '_tz_str')
+
     def __init__(self, utc_date, local_date, tweet):
         self.utc_date   = utc_date
         self.local_date = local_date
         self.tweet      = tweet
+        self._tz_str    = tz_str(utc_date - local_date)
 
 
     @classmethod
@@ -141,26 +167,95 @@ class TweetEnvelope:
         fields = line.split('\t')
 
         # Re-order this to be a bit more amenable to the layout in this project
-        local_date = dateparser.parse(fields[0])
-        utc_date   = dateparser.parse(fields[1])
+        local_date = parse_iso_date(fields[0])
+        utc_date   = parse_iso_date(fields[1])
         # the third field is time-zone difference which we ignore
         tweet, _   = TweetBody.from_str_fields(fields, 3)
 
         return TweetEnvelope(utc_date=utc_date, local_date=local_date, tweet=tweet)
 
     def __str__(self):
-        # Figure out the timezone string
-        diff = self.utc_date - self.local_date
-        rounded_diff = int(diff.total_seconds() / QuarterHourAsSecs) * QuarterHourAsSecs
-        hours = int (rounded_diff / HourAsSecs)
-        mins  = int ((rounded_diff % HourAsSecs) / MinAsSecs)
+        fields = [ self.local_date.isoformat(), self.utc_date.isoformat(), self._tz_str] + self.tweet.to_str_fields()
+        return "\t".join(fields)
 
-        tz_str = "%02d:%02d" % (hours, mins)
 
-        # Then write it out.
-        fields = [ self.local_date.isoformat(), self.utc_date.isoformat(), tz_str] + self.tweet.to_str_fields()
-        return "\t".join(fields)
+def tz_str(diff):
+    """
+    Formats the given difference between a UTC and a local time, a timedelta,
+    truncated towards zero to a whole number of quarter-hours, as the "HH:MM"
+    time-zone string of a tweets file. This uses integer arithmetic only.
+    """
+    secs     = int(diff.total_seconds())
+    quarters = abs(secs) // QuarterHourAsSecs
+    rounded_diff = quarters * QuarterHourAsSecs * (1 if secs >= 0 else -1)
+    hours = abs(rounded_diff) // HourAsSecs * (1 if rounded_diff >= 0 else -1)
+    mins  = (rounded_diff % HourAsSecs) // MinAsSecs
+
+    return "%02d:%02d" % (hours, mins)
+
+
+
+class TweetFileWriter:
+    """
+    Writes TweetEnvelopes out to a tweets file, one per line, on a background thread, so
+    that serializing and writing tweets overlaps with whatever the caller does to get the
+    next one (e.g. downloading it). This is a context manager: once the with-block exits
+    the file has been completely written and closed, and any error raised while writing
+    is re-raised.
+
+    Tweets are written to a partial file alongside the tweets file, which only replaces
+    it if the with-block completes without error, so a failed download leaves any
+    existing tweets file untouched.
+    """
+    def __init__(self, path):
+        self.path    = path
+        self._queue  = queue.Queue(maxsize=MaxQueuedWrites)
+        self._error  = None
+        self._file   = None
+        self._thread = None
+
+    def __enter__(self):
+        self._file   = open(self.path + PartialFileExt, "w")
+        self._thread = threading.Thread(target=self._write_queued, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+        if self._error is None and exc_type is None:
+            os.replace(self.path + PartialFileExt, self.path)
+            return False
+
+        os.remove(self.path + PartialFileExt)
+        if exc_type is None:
+            raise self._error
+        return False
+
+    def write(self, envelope):
+        """
+        Queue the given TweetEnvelope to be written out. Blocks if MaxQueuedWrites tweets
+        are already waiting.
+        """
+        if self._error is not None:
+            raise self._error
+        self._queue.put(envelope)
 
+    def _write_queued(self):
+        """
+        Run by the background thread: writes out queued tweets till it's given None. After
+        an error it keeps emptying the queue, so the caller is never blocked on it.
+        """
+        while True:
+            envelope = self._queue.get()
+            if envelope is None:
+                return
+            if self._error is None:
+                try:
+                    self._file.write(str(envelope) + '\n')
+                except Exception as e:
+                    self._error = e
 
 
 def tweet_files(dir):
@@ -168,67 +263,82 @@ def tweet_files(dir):
     Given a directory of tweet files broken down by category, so it's laid out in
     the form <parent>/<cat-dir>/<screen-name>.<count> return the full list of files.
     This is returned as a map from categories to a map of users to a list of user-files
-    which is sorted
+    which is sorted in ascending order
     """
-    result = dict()
-    sub_dirs = os.listdir(dir)
-    for sub_dir_name in sub_dirs:
-        sub_dir_name = dir + os.sep + sub_dir_name
-        sub_dir = Path(sub_dir_name)
-        if (not sub_dir.is_dir()) or sub_dir.name.startswith("."):
-            continue
-
-        sub_dir_contents = [sub_dir_name + os.sep + f for f in os.listdir(sub_dir_name)]
-        user_files = [f for f in sub_dir_contents if is_visible_file(f)]
-        if len(user_files) == 0:
-            continue
-
-        catgy_list = dict()
-        result[sub_dir.name] = catgy_list
-
-        user_files.sort(reverse=True)
-
-        current_user_batch = [user_files.pop()]
-        current_user_name  = screen_name_from_tweets_file(user_files[0])
-        while len(user_files) > 0:
-            f = user_files.pop()
-            p = Path(f)
-            fname = p.name
-
-            if fname.startswith(current_user_name):
-                current_user_batch.insert(0, f)
-            else:
-                catgy_list[current_user_name] = current_user_batch
-                current_user_name = screen_name_from_tweets_file(f)
-                current_user_batch = [f]
-
-        catgy_list[current_user_name] = current_user_batch
+    with os.scandir(dir) as sub_dirs:
+        sub_dirs = [d for d in sub_dirs if d.is_dir() and not d.name.startswith(".")]
 
-    return result
+    # Scanning is I/O bound, so the category directories are scanned concurrently
+    with ThreadPoolExecutor(max_workers=MaxIoThreads) as pool:
+        return {
+            name: usermap for name, usermap in pool.map(_scan_subdir, sub_dirs)
+            if len(usermap) > 0
+        }
+
+def _scan_subdir(sub_dir):
+    """
+    Does the work of <code>tweet_files</code> for a single category directory, given
+    as an os.DirEntry, returning a tuple of the category name and its map of users to
+    sorted user-files
+    """
+    # scandir() gives us each file's type without a stat() per file
+    with os.scandir(sub_dir.path) as sub_dir_contents:
+        user_files = [f.path for f in sub_dir_contents if f.is_file() and not f.name.startswith(".")]
+
+    # Sorting puts each user's files next to one another, as they all share
+    # the "<screen-name>." prefix
+    user_files.sort()
+    return sub_dir.name, {
+        user: list(batch)
+        for user, batch in groupby(user_files, key=screen_name_from_tweets_file)
+    }
 
 def min_ids_and_dates (catuserfiles):
     """
     Given a map of category -> user -> user-files (As returned by <code>tweet_Files</code>)
     return a map of category -> user -> (tweet_date, tweet_id), with the oldest tweet-id for
     each user.
+
+    This is I/O bound, so categories are read concurrently on a pool of threads.
+    """
+    with ThreadPoolExecutor(max_workers=MaxIoThreads) as pool:
+        catmaps = pool.map(_min_ids_and_dates_for_category, catuserfiles.values())
+        return dict(zip(catuserfiles.keys(), catmaps))
+
+def min_ids_and_dates_by_user (catuserfiles):
+    """
+    Like <code>min_ids_and_dates</code>, but reduced across categories, as the same user may
+    appear in several: returns a map of user -> (tweet_id, tweet_date) with the oldest
+    tweet-id for each user across all categories. Each category is merged in as soon as
+    it's been read.
     """
     result = dict()
-    for caty, usermap in catuserfiles.items():
-        catmap = dict()
-        result[caty] = catmap
-        for user, userfiles in usermap.items():
-            with open (userfiles.pop(), "r") as f:
-                envelope = TweetEnvelope.from_str(f.readline())
-                catmap[user] = (envelope.tweet.tweet_id, envelope.utc_date)
+    with ThreadPoolExecutor(max_workers=MaxIoThreads) as pool:
+        for catmap in pool.map(_min_ids_and_dates_for_category, catuserfiles.values()):
+            for user, id_and_date in catmap.items():
+                current = result.get(user)
+                if current is None or id_and_date[0] < current[0]:
+                    result[user] = id_and_date
 
     return result
 
-def is_visible_file(f):
-    p = Path(f)
-    return p.is_file() and (not p.name.startswith("."))
+def _min_ids_and_dates_for_category (usermap):
+    """
+    Does the work of <code>min_ids_and_dates</code> for a single category's map of
+    user -> user-files, returning a map of user -> (tweet_id, tweet_date)
+    """
+    catmap = dict()
+    for user, userfiles in usermap.items():
+        with open (userfiles[0], "rb") as f:
+            # Only the id and date are needed, so rather than parse the whole tweet, just
+            # split off the header: local-date, utc-date, time-zone, author and tweet-id
+            header = f.readline().split(b'\t', 5)
+            catmap[user] = (int(header[4]), parse_iso_date(header[1].decode('ascii')))
+
+    return catmap
 
 def screen_name_from_tweets_file (filename):
-    filename = Path(filename).name
+    filename = os.path.basename(filename)
     pos = filename.rfind(".")
     if pos < 0:
         return filename